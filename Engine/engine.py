@@ -17,6 +17,8 @@
 """
 
 import os
+import re
+import sys
 import pickle
 import numpy as np
 import pandas as pd
@@ -29,13 +31,24 @@ class SearchIndex:
         This contains the core functionality of the search engine. It manages the inndexing the documents and provides the capability to searhc those documents.
     """
     
-    def __init__(self, text_fields: List[str], keyword_fields: List[str], vectorizer_params: Optional[Dict] = None, boosting_factors: Optional[Dict[str, float]] = None):
+    def __init__(self, text_fields: List[str], keyword_fields: List[str], vectorizer_params: Optional[Dict] = None, boosting_factors: Optional[Dict[str, float]] = None,
+                 chunk_fields: Optional[List[str]] = None, chunk_size: int = 100, chunk_overlap: int = 20):
         """ 
             text_fields: Fields in the JSON documents that contain the text data that we want to index like ['question', 'answer']
             keyword_fields: Fields in the JSON documents that we will use for the exact matching like ['section', 'course']
             vectorizers: A dictionary of the TfidfVectorizer objects, one for each of the text fields. These will be used to convert the text data into TF-IDF Vectors. 
+            chunk_fields: Text fields (like ['answer']) that are split into overlapping passages at fit time. Each passage gets its own TF-IDF row, so a long answer no longer dilutes the weights of its relevant part.
+            chunk_size: Number of words in each passage.
+            chunk_overlap: Number of words shared by two consecutive passages, so a sentence cut at a boundary is still found whole in one of them.
             
         """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive number of words")
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError("chunk_overlap must be at least 0 and smaller than chunk_size")
+        unknown_chunk_fields = [field for field in (chunk_fields or []) if field not in text_fields]
+        if unknown_chunk_fields:
+            raise ValueError(f"chunk_fields must be text fields, unknown: {unknown_chunk_fields}")
         
         self.text_fields = text_fields
         self.keyword_fields = keyword_fields
@@ -55,15 +68,84 @@ class SearchIndex:
         self.keyword_df = None
         self.text_matrices = {}
         
+        # Passage chunking settings and, per chunked field, an (n_passages, 3) array of (document id, start, end).
+        # Passages are kept as character offsets into the parent document's text rather than as copies of it.
+        self.chunk_fields = list(chunk_fields or [])
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.chunk_offsets = {}
+        
     def save_to_pickle(self, pickle_file: str):
         """Saves the precomputed data to a pickle file for future use."""
         with open(pickle_file, 'wb') as f:
-            pickle.dump((self.text_matrices, self.vectorizers, self.keyword_df, self.documents), f)
+            settings = {
+                'text_fields': self.text_fields,
+                'keyword_fields': self.keyword_fields,
+                'boosting_factors': self.boosting_factors,
+                'chunk_size': self.chunk_size,
+                'chunk_overlap': self.chunk_overlap,
+            }
+            pickle.dump((self.text_matrices, self.vectorizers, self.keyword_df, self.documents, self.chunk_offsets, settings), f)
 
     def load_from_pickle(self, pickle_file: str):
         """Loads the precomputed data from a pickle file."""
         with open(pickle_file, 'rb') as f:
-            self.text_matrices, self.vectorizers, self.keyword_df, self.documents = pickle.load(f)
+            data = pickle.load(f)
+        self.text_matrices, self.vectorizers, self.keyword_df, self.documents = data[:4]
+        # Pickles written before passage chunking only hold four items
+        self.chunk_offsets = data[4] if len(data) > 4 else {}
+        self.chunk_fields = list(self.chunk_offsets)
+        # Newer pickles also describe the configuration they were fitted with, older ones keep the one given to the constructor
+        settings = data[5] if len(data) > 5 else {}
+        for name in ('text_fields', 'keyword_fields', 'boosting_factors', 'chunk_size', 'chunk_overlap'):
+            if name in settings:
+                setattr(self, name, settings[name])
+    
+    def memory_usage(self) -> int:
+        """
+            Estimates the number of bytes held by the index: the TF-IDF matrices, the vectorizer vocabularies, the keyword dataframe, the passage offsets and the raw documents.
+            It is an approximation, meant for comparing indexes against each other and against a memory budget.
+        """
+        total = 0
+        for matrix in self.text_matrices.values():
+            total += matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+        for vectorizer in self.vectorizers.values():
+            vocabulary = getattr(vectorizer, 'vocabulary_', {})
+            total += sys.getsizeof(vocabulary) + sum(sys.getsizeof(term) for term in vocabulary)
+            idf = getattr(vectorizer, 'idf_', None)
+            total += idf.nbytes if idf is not None else 0
+        if self.keyword_df is not None:
+            total += int(self.keyword_df.memory_usage(deep=True).sum())
+        total += sum(offsets.nbytes for offsets in self.chunk_offsets.values())
+        total += sum(sys.getsizeof(doc) + sum(sys.getsizeof(value) for value in doc.values()) for doc in self.documents)
+        return total
+    
+    def chunk_text(self, text: str) -> List[tuple]:
+        """
+            Splits a text into overlapping windows of `chunk_size` words and returns them as (start, end) character offsets.
+            Consecutive windows share `chunk_overlap` words. The offsets point into the original text, so `text[start:end]` gives the passage back.
+        """
+        words = [match.span() for match in re.finditer(r'\S+', text)]
+        step = self.chunk_size - self.chunk_overlap
+        spans = []
+        for first in range(0, len(words), step):
+            last = min(first + self.chunk_size, len(words)) - 1
+            spans.append((words[first][0], words[last][1]))
+            if last == len(words) - 1:
+                break
+        return spans
+    
+    def _chunk_field(self, documents: List[Dict[str, str]], field: str) -> np.ndarray:
+        """Builds the (document id, start, end) offsets of every passage of a field across all the documents."""
+        offsets = [(doc_id, start, end)
+                   for doc_id, doc in enumerate(documents)
+                   for start, end in self.chunk_text(doc.get(field, '') or '')]
+        return np.array(offsets, dtype=np.int64).reshape(-1, 3)
+    
+    def passage_text(self, field: str, passage_id: int) -> str:
+        """Returns the text of a passage by slicing it out of its parent document."""
+        doc_id, start, end = self.chunk_offsets[field][passage_id]
+        return self.documents[doc_id].get(field, '')[start:end]
     
         
     def fit(self, documents: List[Dict[str,str]], pickle_file: str = None) -> 'SearchIndex':
@@ -91,8 +173,16 @@ class SearchIndex:
             #     - Convert text into TF-IDF matrix using the TfidfVectorizer. Use the TfidfVectorizer instance that created in the init method to convert the text into matrix.
             #     - store this matrix 
         
+        #     - Chunked fields are split into passages first, and the matrix gets one row per passage instead of one per document.
+        
+        self.chunk_offsets = {}
         for field in self.text_fields:
-            texts = [doc.get(field, '') for doc in documents]
+            if field in self.chunk_fields:
+                offsets = self._chunk_field(documents, field)
+                self.chunk_offsets[field] = offsets
+                texts = [documents[doc_id][field][start:end] for doc_id, start, end in offsets]
+            else:
+                texts = [doc.get(field, '') for doc in documents]
             matrix = self.vectorizers[field].fit_transform(texts)
             # Apply boosting at the indexing stage if specified
             if field in self.boosting_factors:
@@ -106,7 +196,19 @@ class SearchIndex:
             self.save_to_pickle(pickle_file)
         return self
     
-    def search(self, user_query: str, num_results: int = 5, filter_dict: Dict[str, str] = None) -> List[Dict[str, Any]]:
+    def _filter_mask(self, filter_dict: Optional[Dict[str, str]]) -> np.ndarray:
+        """Returns a 0/1 array over the documents, with 1 for the documents matching every keyword filter."""
+        mask = np.ones(len(self.documents))
+        if filter_dict:
+            for field, value in filter_dict.items():
+                if field in self.keyword_fields and value in self.keyword_df[field].values:
+                    mask *= (self.keyword_df[field] == value).astype(int).to_numpy()
+                else:
+                    mask *= 0  # Apply zero mask if filter does not match any document
+        return mask
+    
+    def search(self, user_query: str, num_results: int = 5, filter_dict: Dict[str, str] = None,
+               aggregation: str = 'max', return_passages: bool = False) -> List[Dict[str, Any]]:
         """ 
         Objective:
             - Implement a method that takes a query and returns the most relevant documents based on how similar they are to the query.
@@ -117,10 +219,20 @@ class SearchIndex:
                 - Use cosine similarity to compare the query vector with the document vectors, which will give us a measure of how similar each document is to the query.
                 - Accumulate these scores.
             - Rank the top documents by their similarity score and return the top results.
+        Chunked fields:
+            - The query is compared with every passage, and the passage scores are rolled up to their parent document with `aggregation`:
+                - 'max': a document is as relevant as its best passage.
+                - 'sum': every matching passage adds to the document score, favouring documents that talk about the query in several places.
+            - With `return_passages=True` the passages themselves are ranked and returned instead of whole documents. A passage is scored by its own similarity plus the score of its parent document on the fields that are not chunked, and passages that do not match the query are left out.
         """
+        if aggregation not in ('max', 'sum'):
+            raise ValueError(f"Unknown aggregation '{aggregation}', expected 'max' or 'sum'")
+        if return_passages and not self.chunk_offsets:
+            raise ValueError("return_passages requires an index fitted with chunk_fields")
         
         # Initialize the array to hold the similarity scores of the documents 
         similarity_scores = np.zeros(len(self.documents))
+        passage_scores = {}
         
         # Compute the similarity score for each text field in the documents
         for field, vectorizer in self.vectorizers.items():
@@ -134,17 +246,29 @@ class SearchIndex:
             # Inside the search method, add a boosting factor
             boost = self.boosting_factors.get(field, 1.0)
             
-            # Accumulate the scores
-            similarity_scores += similarity * boost
+            if field in self.chunk_offsets:
+                # Keep the passage scores and roll them up to their parent documents
+                doc_ids = self.chunk_offsets[field][:, 0]
+                passage_scores[field] = similarity * boost
+                if return_passages:
+                    continue
+                if aggregation == 'max':
+                    field_scores = np.zeros(len(self.documents))
+                    np.maximum.at(field_scores, doc_ids, similarity)
+                else:
+                    field_scores = np.bincount(doc_ids, weights=similarity, minlength=len(self.documents))
+                similarity_scores += field_scores * boost
+            else:
+                # Accumulate the scores
+                similarity_scores += similarity * boost
         
         # Apply filtering based on filter_dict
-        if filter_dict:
-            for field, value in filter_dict.items():
-                if field in self.keyword_fields and value in self.keyword_df[field].values:
-                    mask = self.keyword_df[field] == value
-                    similarity_scores *= mask.astype(int).to_numpy()
-                else:
-                    similarity_scores *= 0  # Apply zero mask if filter does not match any document
+        mask = self._filter_mask(filter_dict)
+        
+        if return_passages:
+            return self._top_passages(passage_scores, similarity_scores, mask, num_results)
+        
+        similarity_scores *= mask
     
         # Rank documents by their scores, get the indices of the top results
         top_indices = np.argsort(similarity_scores)[-num_results:][::-1]
@@ -153,3 +277,37 @@ class SearchIndex:
         top_docs = [self.documents[i] for i in top_indices if similarity_scores[i] > 0]
 
         return top_docs
+    
+    def _top_passages(self, passage_scores: Dict[str, np.ndarray], document_scores: np.ndarray, mask: np.ndarray, num_results: int) -> List[Dict[str, Any]]:
+        """
+            Ranks the passages of all chunked fields together and returns the best ones with the keyword fields of their parent document.
+            Only passages that match the query themselves are returned. The parent document score only reorders them, so a document
+            matching on its question alone does not bring along passages that have nothing to do with the query.
+        """
+        fields = list(passage_scores)
+        scores = np.concatenate([
+            np.where(passage_scores[field] > 0, passage_scores[field] + document_scores[self.chunk_offsets[field][:, 0]], 0)
+            * mask[self.chunk_offsets[field][:, 0]]
+            for field in fields
+        ])
+        # Position in `scores` where the passages of each field start
+        field_starts = np.cumsum([0] + [len(passage_scores[field]) for field in fields])
+        
+        top_passages = []
+        for i in np.argsort(scores)[-num_results:][::-1]:
+            if scores[i] <= 0:
+                continue
+            field_index = np.searchsorted(field_starts, i, side='right') - 1
+            field = fields[field_index]
+            passage_id = i - field_starts[field_index]
+            doc_id, start, end = (int(value) for value in self.chunk_offsets[field][passage_id])
+            passage = {keyword: self.documents[doc_id].get(keyword, '') for keyword in self.keyword_fields}
+            passage.update({
+                'document_id': doc_id,
+                'field': field,
+                'start': start,
+                'end': end,
+                'text': self.passage_text(field, passage_id),
+            })
+            top_passages.append(passage)
+        return top_passages
@@ -0,0 +1,181 @@
+"""
+    Objective:
+        - To keep the search indexes in one place for the whole process, instead of one copy per browser session.
+    Core Concept:
+        - Every index is identified by a key, the path of the pickle file it is stored in. Two sessions asking for the same key share the same SearchIndex object.
+        - An index is loaded only once, even when several sessions ask for it at the same time.
+        - Memory Budget:
+            - The registry estimates the size of every index it holds and keeps the total under a configurable budget.
+            - When a new index does not fit, the least recently used indexes are evicted first.
+        - Warming:
+            - Indexes can be registered before anyone asks for them, for example every pickle found in the vector store at startup.
+            - A background thread loads the registered indexes that are not in memory yet, the most frequently requested first, as long as they fit in the free budget. Switching to a warmed index is then instant.
+            - Warming never evicts anything. An index whose estimated size (for example the size of its pickle file) does not fit is not loaded at all, and one that turns out not to fit once loaded is dropped, with its size remembered so it is not tried again.
+            - An index that fails to load while warming is skipped from then on, so one broken pickle does not stop the others from being warmed.
+"""
+
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+from Engine.engine import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+
+class IndexRegistry:
+    """
+        A process-wide, thread-safe cache of SearchIndex objects with a memory budget and least-recently-used eviction.
+    """
+
+    def __init__(self, memory_budget: int):
+        """
+            memory_budget: Maximum number of bytes, as estimated by SearchIndex.memory_usage, that the registry keeps loaded. The most recently requested index is always kept, even if it is larger than the budget on its own.
+        """
+        self.memory_budget = memory_budget
+
+        # Loaded indexes, ordered from the least to the most recently used, and the last estimated size of every index ever loaded
+        self._indexes: 'OrderedDict[Hashable, SearchIndex]' = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        # Size estimates given at registration, used before an index has ever been loaded, and the keys that failed to warm
+        self._size_estimates: Dict[Hashable, int] = {}
+        self._failed: Set[Hashable] = set()
+
+        # How to (re)load each registered key, in registration order, and how often it was requested
+        self._loaders: Dict[Hashable, Callable[[], SearchIndex]] = {}
+        self._hits: Counter = Counter()
+
+        self._lock = threading.RLock()
+        self._load_locks: Dict[Hashable, threading.Lock] = {}
+        self._warm_thread: Optional[threading.Thread] = None
+
+    def register(self, key: Hashable, loader: Callable[[], SearchIndex], size_estimate: Optional[int] = None):
+        """
+            Remembers how to load an index without loading it, so that it can be warmed in the background.
+            size_estimate: Cheap guess of the index size, like the size of its pickle file. Warming skips the index while this does not fit in the free budget.
+        """
+        with self._lock:
+            self._loaders[key] = loader
+            self._failed.discard(key)
+            if size_estimate is not None:
+                self._size_estimates[key] = size_estimate
+
+    def get(self, key: Hashable, loader: Optional[Callable[[], SearchIndex]] = None) -> SearchIndex:
+        """
+            Returns the index for the key, loading it with `loader` if it is not already in memory.
+            The loader may be left out for a key that was registered before.
+        """
+        with self._lock:
+            if loader is not None:
+                self._loaders[key] = loader
+            elif key not in self._loaders:
+                raise KeyError(f"No loader registered for index {key!r}")
+            self._hits[key] += 1
+
+        search_index = self._load(key, evict=True)
+        self.warm_in_background()
+        return search_index
+
+    def _load(self, key: Hashable, evict: bool) -> Optional[SearchIndex]:
+        """
+            Returns the index for the key, loading it at most once even when several threads ask for it together.
+            With `evict=False` the index is only kept if it fits in the free budget, otherwise it is dropped and None is returned.
+        """
+        with self._lock:
+            if key in self._indexes:
+                if evict:
+                    self._indexes.move_to_end(key)
+                return self._indexes[key]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+            loader = self._loaders[key]
+
+        with load_lock:
+            # Another thread may have finished loading while we were waiting for the lock
+            with self._lock:
+                if key in self._indexes:
+                    if evict:
+                        self._indexes.move_to_end(key)
+                    return self._indexes[key]
+
+            search_index = loader()
+            size = search_index.memory_usage()
+
+            # The budget check and the insertion happen under the same lock, so nothing can be loaded in between
+            with self._lock:
+                self._sizes[key] = size
+                self._failed.discard(key)
+                if not evict:
+                    if size > self.memory_budget - self.memory_usage():
+                        return None
+                    # A warmed index has not been used yet, so it is the first one to go
+                    self._indexes[key] = search_index
+                    self._indexes.move_to_end(key, last=False)
+                    return search_index
+                self._indexes[key] = search_index
+                self._evict()
+            return search_index
+
+    def _evict(self):
+        """Drops the least recently used indexes until the total size fits in the budget. Must be called with the lock held."""
+        while len(self._indexes) > 1 and self.memory_usage() > self.memory_budget:
+            self._indexes.popitem(last=False)
+
+    def _warm_candidates(self) -> List[Hashable]:
+        """
+            Returns the registered keys that are not loaded and whose last known size fits in the free budget, the most requested first.
+            Must be called with the lock held.
+        """
+        free = self.memory_budget - self.memory_usage()
+        order = {key: position for position, key in enumerate(self._loaders)}
+        candidates = [
+            key for key in self._loaders
+            if key not in self._indexes and key not in self._failed
+            and self._sizes.get(key, self._size_estimates.get(key, 0)) <= free
+        ]
+        return sorted(candidates, key=lambda key: (-self._hits[key], order[key]))
+
+    def warm(self):
+        """
+            Loads the registered indexes that are not in memory, for as long as they fit in the free budget. Never evicts an index.
+            An index that fails to load is logged and left out of later warming, until it is registered again or loaded by `get`.
+        """
+        with self._lock:
+            candidates = self._warm_candidates()
+        for key in candidates:
+            with self._lock:
+                if key not in self._warm_candidates():
+                    continue
+            try:
+                self._load(key, evict=False)
+            except Exception as error:
+                logger.warning("Could not warm index %r: %s", key, error)
+                with self._lock:
+                    self._failed.add(key)
+
+    def warm_in_background(self):
+        """Starts a background thread running `warm`, unless one is already running or there is nothing to warm."""
+        with self._lock:
+            if self._warm_thread is not None and self._warm_thread.is_alive():
+                return
+            if not self._warm_candidates():
+                return
+            self._warm_thread = threading.Thread(target=self.warm, name='index-registry-warm', daemon=True)
+            self._warm_thread.start()
+
+    def wait_for_warming(self, timeout: Optional[float] = None):
+        """Blocks until the current background warming, if any, is finished."""
+        with self._lock:
+            thread = self._warm_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def memory_usage(self) -> int:
+        """Returns the estimated number of bytes held by the loaded indexes."""
+        with self._lock:
+            return sum(self._sizes[key] for key in self._indexes)
+
+    def loaded_keys(self) -> List[Hashable]:
+        """Returns the keys of the loaded indexes, from the least to the most recently used."""
+        with self._lock:
+            return list(self._indexes)
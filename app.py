@@ -143,13 +143,16 @@
 import streamlit as st
 import os
 import json
+import hashlib
 import pandas as pd
 from flatten_json import flatten
 from Engine.engine import SearchIndex
+from Engine.registry import IndexRegistry
 from Engine.elasticsearch_engine import ElasticsearchEngine  # Import the Elasticsearch engine
 
 DATA_DIR = 'Knowledge_Base'
 PICKLE_DIR = 'VectorStore'
+INDEX_MEMORY_BUDGET_MB = float(os.getenv('INDEX_MEMORY_BUDGET_MB', '512'))
 
 # Utility function to generate a dynamic index name based on the file name or other context
 def generate_index_name(file_name):
@@ -165,6 +168,15 @@ def initialize_elasticsearch_engine(file_name):
 def file_path(filename):
     return os.path.join(DATA_DIR, filename)
 
+def pickle_path(file_name, text_fields, keyword_fields, boosting_factors, chunk_fields=(), chunk_size=100, chunk_overlap=20):
+    """Construct a pickle path for the given filename and index configuration, so that every configuration gets its own pickle."""
+    base_filename = os.path.splitext(file_name)[0]
+    config = (sorted(text_fields), sorted(keyword_fields), sorted(boosting_factors.items()))
+    if chunk_fields:
+        config += (sorted(chunk_fields), chunk_size, chunk_overlap)
+    digest = hashlib.md5(repr(config).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(PICKLE_DIR, f"{base_filename}_{digest}.pkl")
+
 def load_documents(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         return json.load(file)
@@ -188,20 +200,72 @@ def load_existing_pickles():
     pickles = [f for f in os.listdir(PICKLE_DIR) if f.endswith('.pkl')]
     return pickles
 
-def load_or_create_index(file_name, text_fields, keyword_fields, boosting_factors):
+def build_index(pickle_file, file_name, text_fields, keyword_fields, boosting_factors, chunk_fields=(), chunk_size=100, chunk_overlap=20):
     """Load an existing index from a pickle file or create a new one if not available."""
-    pickle_file = pickle_path(file_name)
+    search_index = SearchIndex(text_fields, keyword_fields, boosting_factors=boosting_factors,
+                               chunk_fields=list(chunk_fields), chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     if os.path.exists(pickle_file):
-        st.info(f"Loading index from pickle file: {pickle_file}")
-        search_index = SearchIndex(text_fields, keyword_fields, boosting_factors=boosting_factors)
         search_index.load_from_pickle(pickle_file)
     else:
-        st.info("No pickle file found. Indexing the document.")
         documents = load_documents(file_path(file_name))
-        search_index = SearchIndex(text_fields, keyword_fields, boosting_factors=boosting_factors)
         search_index.fit(documents, pickle_file=pickle_file)
+    return search_index
+
+def load_pickled_index(pickle_file):
+    """Load an index saved in the vector store."""
+    search_index = SearchIndex([], [])
+    search_index.load_from_pickle(pickle_file)
+    return search_index
+
+def index_loader(pickle_file, config=None):
+    """Return a function loading the index stored in the pickle file, or building it from the configuration if the file does not exist yet."""
+    if config is None:
+        return lambda: load_pickled_index(pickle_file)
+    return lambda: build_index(pickle_file, **config)
+
+@st.cache_resource
+def get_index_registry():
+    """Return the process-wide index registry, shared by every browser session."""
+    registry = IndexRegistry(memory_budget=int(INDEX_MEMORY_BUDGET_MB * 1024 * 1024))
+    # Register the indexes already in the vector store, so they are warmed in the background before anyone asks for them
+    for pickle_name in load_existing_pickles():
+        pickle_file = os.path.join(PICKLE_DIR, pickle_name)
+        registry.register(pickle_file, index_loader(pickle_file), size_estimate=os.path.getsize(pickle_file))
+    registry.warm_in_background()
+    return registry
+
+def get_session_index():
+    """Get the index of the current session from the shared registry, reloading it if it was evicted or the registry was cleared."""
+    pickle_file = st.session_state['index_pickle']
+    return get_index_registry().get(pickle_file, index_loader(pickle_file, st.session_state.get('index_config')))
+
+def load_or_create_index(file_name, text_fields, keyword_fields, boosting_factors, chunk_fields=(), chunk_size=100, chunk_overlap=20):
+    """Get the index from the shared registry, building or loading it only if no session has it in memory."""
+    config = {
+        'file_name': file_name,
+        'text_fields': text_fields,
+        'keyword_fields': keyword_fields,
+        'boosting_factors': boosting_factors,
+        'chunk_fields': chunk_fields,
+        'chunk_size': chunk_size,
+        'chunk_overlap': chunk_overlap,
+    }
+    # Sessions only keep how to find the index, so an evicted index is really freed
+    pickle_file = pickle_path(**config)
+    st.session_state['index_pickle'] = pickle_file
+    st.session_state['index_config'] = config
+    
+    # The loaders also run in the warming thread, so the status messages are shown here rather than inside them
+    if pickle_file in get_index_registry().loaded_keys():
+        get_session_index()
+    elif os.path.exists(pickle_file):
+        with st.spinner(f"Loading index from pickle file: {pickle_file}"):
+            get_session_index()
+    else:
+        with st.spinner("No pickle file found. Indexing the document."):
+            get_session_index()
+    st.success("Index ready. You can start searching.")
     
-    st.session_state['search_index'] = search_index
     st.session_state['keyword_fields'] = keyword_fields
     st.session_state['index_configured'] = True
 
@@ -226,6 +290,16 @@ def display_document_fields(file_name, use_elasticsearch):
             with col3 if idx % 2 == 0 else col4:
                 boost_factors[field] = st.number_input(f"Boost for {field}", min_value=0.1, max_value=10.0, value=1.0, step=0.1)
 
+        st.subheader("Split Long Text Fields into Passages")
+        chunk_fields = st.multiselect('Select Text Fields to Split into Passages', options=text_fields)
+        chunk_size, chunk_overlap = 100, 20
+        if chunk_fields:
+            col5, col6 = st.columns(2)
+            with col5:
+                chunk_size = st.number_input("Words per passage", min_value=10, max_value=1000, value=100, step=10)
+            with col6:
+                chunk_overlap = st.number_input("Words shared by consecutive passages", min_value=0, max_value=chunk_size - 1, value=min(20, chunk_size - 1), step=5)
+
         if st.button('Configure Index'):
             if use_elasticsearch:
                 es_engine = initialize_elasticsearch_engine(file_name)
@@ -236,7 +310,7 @@ def display_document_fields(file_name, use_elasticsearch):
                     es_engine.index_documents(documents)
                     st.success(f"Documents indexed in Elasticsearch! Index name: {es_engine.index_name}")
             else:
-                load_or_create_index(file_name, text_fields, keyword_fields, boost_factors)
+                load_or_create_index(file_name, text_fields, keyword_fields, boost_factors, chunk_fields, int(chunk_size), int(chunk_overlap))
             st.session_state['index_ready'] = True
 
 def search_interface(use_elasticsearch, file_name):
@@ -249,14 +323,20 @@ def search_interface(use_elasticsearch, file_name):
             filter_dict = {}  # Define filters if necessary
             results = es_engine.search_documents(query, fields, filter_dict)
         else:
+            search_index = get_session_index()
             filter_dict = {}
             if 'keyword_fields' in st.session_state:
                 for field in st.session_state['keyword_fields']:
-                    options = pd.Series([doc[field] for doc in st.session_state['search_index'].documents if field in doc]).unique()
+                    options = pd.Series([doc[field] for doc in search_index.documents if field in doc]).unique()
                     selected_option = st.selectbox(f"Filter by {field}", [''] + list(options))
                     if selected_option:
                         filter_dict[field] = selected_option
-            results = st.session_state['search_index'].search(query, filter_dict=filter_dict)
+            search_params = {}
+            if search_index.chunk_offsets:
+                search_params['return_passages'] = st.checkbox("Return matching passages instead of whole documents")
+                if not search_params['return_passages']:
+                    search_params['aggregation'] = st.radio("Score documents by their passages' scores", ('max', 'sum'), horizontal=True)
+            results = search_index.search(query, filter_dict=filter_dict, **search_params)
 
         if results:
             st.write("Search Results:", results)
@@ -296,9 +376,9 @@ elif option == "Use Existing Index":
         selected_pickle = st.selectbox("Select an existing index:", existing_pickles)
         if selected_pickle:
             pickle_file = os.path.join(PICKLE_DIR, selected_pickle)
-            search_index = SearchIndex([], [])  
-            search_index.load_from_pickle(pickle_file)
-            st.session_state['search_index'] = search_index
+            st.session_state['index_pickle'] = pickle_file
+            st.session_state['index_config'] = None
+            search_index = get_session_index()
             st.session_state['keyword_fields'] = search_index.keyword_fields
             st.session_state['index_configured'] = True
             st.success(f"Index loaded from {selected_pickle}. Ready to search.")
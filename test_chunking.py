@@ -0,0 +1,112 @@
+import pickle
+
+import pytest
+
+from Engine.engine import SearchIndex
+
+docs = [
+    {
+        'question': 'How do I install docker?',
+        'answer': 'Download the installer from the website. Run it and follow the steps. '
+                  'After that restart the machine. Docker compose is installed together with docker.',
+        'course': 'data-engineering-zoomcamp',
+    },
+    {
+        'question': 'Where is the homework?',
+        'answer': 'The homework is in the course repository. Submit the homework with the form. '
+                  'Homework deadlines are in the calendar. Late homework is not graded.',
+        'course': 'data-engineering-zoomcamp',
+    },
+    {
+        'question': 'Can I use kafka?',
+        'answer': 'Yes, kafka is covered in week six. The homework for kafka uses docker to run the broker.',
+        'course': 'mlops-zoomcamp',
+    },
+]
+
+
+def make_index(**params):
+    params = {'chunk_fields': ['answer'], 'chunk_size': 6, 'chunk_overlap': 2, **params}
+    return SearchIndex(['question', 'answer'], ['course'], **params).fit(docs)
+
+
+def test_chunk_offsets_round_trip():
+    index = make_index()
+    offsets = index.chunk_offsets['answer']
+    assert index.text_matrices['answer'].shape[0] == len(offsets)
+    for passage_id, (doc_id, start, end) in enumerate(offsets):
+        text = docs[doc_id]['answer'][start:end]
+        assert index.passage_text('answer', passage_id) == text
+        assert text == text.strip() and len(text.split()) <= 6
+    # Every word of every answer ends up in at least one passage
+    for doc_id, doc in enumerate(docs):
+        covered = ' '.join(docs[d]['answer'][s:e] for d, s, e in offsets if d == doc_id).split()
+        assert set(doc['answer'].split()) <= set(covered)
+
+
+def test_chunk_text_overlap():
+    index = SearchIndex([], [], chunk_size=3, chunk_overlap=1)
+    assert index.chunk_text('a b  c d e f g') == [(0, 6), (5, 10), (9, 14)]
+    assert index.chunk_text('') == []
+
+
+@pytest.mark.parametrize('params', [
+    {'chunk_size': 0, 'chunk_overlap': 0},
+    {'chunk_size': 0, 'chunk_overlap': -1},
+    {'chunk_size': 5, 'chunk_overlap': -1},
+    {'chunk_size': 5, 'chunk_overlap': 5},
+    {'chunk_fields': ['answers']},
+])
+def test_invalid_chunk_settings(params):
+    params = {'chunk_fields': ['answer'], **params}
+    with pytest.raises(ValueError):
+        SearchIndex(['answer'], [], **params)
+
+
+def test_max_and_sum_aggregation():
+    index = make_index()
+    # The homework answer has several matching passages, the kafka answer a single strong one
+    assert index.search('homework', 3, aggregation='sum')[0] is docs[1]
+    assert {doc['question'] for doc in index.search('homework', 3, aggregation='max')} == {docs[1]['question'], docs[2]['question']}
+    with pytest.raises(ValueError):
+        index.search('homework', aggregation='mean')
+
+
+def test_passages_match_the_query_and_filters():
+    index = make_index()
+    passages = index.search('docker', 10, return_passages=True)
+    assert passages and all('docker' in passage['text'].lower() for passage in passages)
+
+    passages = index.search('docker', 10, filter_dict={'course': 'mlops-zoomcamp'}, return_passages=True)
+    assert passages and all(passage['document_id'] == 2 and passage['course'] == 'mlops-zoomcamp' for passage in passages)
+
+    # Matching only on the question does not bring along the answer passages
+    assert index.search('where', 10) == [docs[1]]
+    assert index.search('where', 10, return_passages=True) == []
+
+
+def test_pickle_keeps_chunks(tmp_path):
+    index = make_index(chunk_size=8, chunk_overlap=3)
+    pickle_file = tmp_path / 'chunked.pkl'
+    index.save_to_pickle(pickle_file)
+
+    loaded = SearchIndex(['question', 'answer'], ['course'])
+    loaded.load_from_pickle(pickle_file)
+    assert loaded.chunk_fields == ['answer']
+    assert (loaded.chunk_size, loaded.chunk_overlap) == (8, 3)
+    assert (loaded.chunk_offsets['answer'] == index.chunk_offsets['answer']).all()
+    assert loaded.search('docker', 5, return_passages=True) == index.search('docker', 5, return_passages=True)
+
+
+def test_old_pickle_without_chunks(tmp_path):
+    index = SearchIndex(['question', 'answer'], ['course']).fit(docs)
+    pickle_file = tmp_path / 'old.pkl'
+    with open(pickle_file, 'wb') as f:
+        pickle.dump((index.text_matrices, index.vectorizers, index.keyword_df, index.documents), f)
+
+    loaded = SearchIndex(['question', 'answer'], ['course'])
+    loaded.load_from_pickle(pickle_file)
+    assert loaded.chunk_offsets == {} and loaded.chunk_fields == []
+    assert loaded.search('docker', 2) == index.search('docker', 2)
+    with pytest.raises(ValueError):
+        loaded.search('docker', return_passages=True)
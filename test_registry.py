@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from Engine.registry import IndexRegistry
+
+
+class FakeIndex:
+    """Stands in for a SearchIndex, the registry only needs its size."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def memory_usage(self):
+        return self.size
+
+
+def make_loader(name, size, loads, delay=0.0):
+    def load():
+        loads.append(name)
+        time.sleep(delay)
+        return FakeIndex(name, size)
+    return load
+
+
+def test_evicts_least_recently_used():
+    loads = []
+    registry = IndexRegistry(memory_budget=250)
+    registry.get('A', make_loader('A', 100, loads))
+    registry.get('B', make_loader('B', 100, loads))
+    registry.get('A')
+    registry.get('C', make_loader('C', 100, loads))
+    # B was used less recently than A, so it goes first
+    assert registry.loaded_keys() == ['A', 'C']
+    assert registry.memory_usage() == 200
+
+
+def test_keeps_an_index_larger_than_the_budget():
+    registry = IndexRegistry(memory_budget=50)
+    registry.get('A', make_loader('A', 100, []))
+    registry.get('B', make_loader('B', 100, []))
+    assert registry.loaded_keys() == ['B']
+
+
+def test_loads_once_under_concurrent_requests():
+    loads = []
+    registry = IndexRegistry(memory_budget=1000)
+    loader = make_loader('A', 100, loads, delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get('A', loader))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ['A']
+    assert results[0] is results[1]
+
+
+def test_get_without_loader():
+    registry = IndexRegistry(memory_budget=1000)
+    with pytest.raises(KeyError):
+        registry.get('A')
+
+
+def test_warms_registered_indexes():
+    loads = []
+    registry = IndexRegistry(memory_budget=250)
+    registry.register('faq', make_loader('faq', 100, loads))
+    registry.register('chat', make_loader('chat', 100, loads))
+    registry.warm_in_background()
+    registry.wait_for_warming()
+    assert sorted(registry.loaded_keys()) == ['chat', 'faq']
+
+    # Switching between the two is served from memory
+    registry.get('faq')
+    registry.get('chat')
+    registry.get('faq')
+    assert sorted(loads) == ['chat', 'faq']
+
+
+def test_warming_never_evicts():
+    loads = []
+    registry = IndexRegistry(memory_budget=150)
+    registry.register('big', make_loader('big', 120, loads))
+    registry.get('small', make_loader('small', 100, loads))
+    registry.wait_for_warming()
+    # The big index was tried once, did not fit, and was dropped without touching the index in use
+    assert registry.loaded_keys() == ['small']
+    registry.warm()
+    assert loads == ['small', 'big']
+
+    # A request still loads it, evicting the least recently used index
+    registry.get('big')
+    assert registry.loaded_keys() == ['big']
+
+
+def test_warming_checks_the_budget_after_loading():
+    loads = []
+    registry = IndexRegistry(memory_budget=150)
+    registry.register('warm', make_loader('warm', 100, loads, delay=0.2))
+    registry.warm_in_background()
+    # While the warm index is loading, a session loads another one that takes the free budget
+    registry.get('used', make_loader('used', 100, loads))
+    registry.wait_for_warming()
+    assert registry.loaded_keys() == ['used']
+
+
+def test_warming_skips_indexes_that_fail_to_load():
+    loads = []
+
+    def broken():
+        loads.append('bad')
+        raise EOFError('truncated pickle')
+
+    registry = IndexRegistry(memory_budget=1000)
+    registry.register('bad', broken)
+    registry.register('good', make_loader('good', 100, loads))
+    registry.warm()
+    registry.warm_in_background()
+    registry.wait_for_warming()
+    assert registry.loaded_keys() == ['good']
+    assert loads == ['bad', 'good']
+
+    # A request still tries the loader and reports its error
+    with pytest.raises(EOFError):
+        registry.get('bad')
+
+
+def test_warming_skips_indexes_estimated_too_large():
+    loads = []
+    registry = IndexRegistry(memory_budget=150)
+    registry.register('big', make_loader('big', 120, loads), size_estimate=200)
+    registry.register('small', make_loader('small', 100, loads), size_estimate=100)
+    registry.warm()
+    assert loads == ['small']
+    assert registry.loaded_keys() == ['small']